@@ -0,0 +1,419 @@
+"""
+Soak test running the bot for hours against local fake Twitter, OpenAI and Discord endpoints.
+
+The fake Twitter stream drops the connection at random, and the harness keeps starting, stopping
+and editing the tracked users like a busy admin would. Live asyncio tasks, open file descriptors
+and traced memory are sampled along the way, and the run fails if any of them keeps growing or
+if more than one stream task is ever running.
+
+Usage: python soak.py --duration 3600
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+
+# The bot reads its configuration when imported, point it at fake credentials and a scratch database
+os.environ["TWITTER_BEARER_TOKEN"] = "soak"
+os.environ["OPENAI_API_KEY"] = "soak"
+os.environ["DISCORD_BOT_TOKEN"] = "soak"
+os.environ["DISCORD_CHANNEL_ID"] = "1"
+os.environ.setdefault("MATCHER_ENGINE", "embedding")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+SCRATCH_DIR = tempfile.TemporaryDirectory(prefix="gpt-tweet-tracker-soak-")
+ORIGINAL_DIR = os.getcwd()
+os.chdir(SCRATCH_DIR.name)
+
+import openai
+
+import src.discordbot
+from src.discordbot import Tracker, CURSOR, cnx
+from src.globals_ import HandleAlreadyExist, UserNotTracked
+from src.history import MatchHistory
+from src.matchers import local_embed
+from src.tenancy import SubscriptionIndex
+from src.twitterStream import MyStreamListener, MATCHER, SCHEDULER
+
+# Fake Twitter users the harness tracks and untracks
+FAKE_USERS = {f"soakuser{i}": 1000 + i for i in range(40)}
+
+TWITTER_API = "https://api.twitter.com"
+
+HOME_CHANNEL_ID = 1
+GUILD_ID = 1
+
+
+class FakeServices:
+    """
+    Fake Twitter and OpenAI HTTP APIs served from a separate thread.
+
+    The OpenAI client blocks the event loop of the bot, so the fake servers need their own loop.
+    """
+
+    def __init__(self, tweet_interval: float, disconnect_after: float) -> None:
+        self.tweet_interval = tweet_interval
+        self.disconnect_after = disconnect_after
+        self.rules = {}
+        self.rule_ids = iter(range(1, 10 ** 9))
+        self.tweet_ids = iter(range(1, 10 ** 12))
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.port = None
+
+    def start(self) -> str:
+        threading.Thread(target=self.run, daemon=True).start()
+        self.ready.wait()
+        return f"http://127.0.0.1:{self.port}"
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        app = web.Application()
+        app.router.add_get("/2/tweets/search/stream", self.stream)
+        app.router.add_get("/2/tweets/search/stream/rules", self.get_rules)
+        app.router.add_post("/2/tweets/search/stream/rules", self.post_rules)
+        app.router.add_post("/v1/engines/{engine}/completions", self.completion)
+        app.router.add_post("/v1/completions", self.completion)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+
+        runner = web.AppRunner(app)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.ready.set()
+        self.loop.run_forever()
+
+    def tracked_handles(self):
+        return [
+            handle.strip()[len("from:"):]
+            for value in self.rules.values()
+            for handle in value.split(" OR ")
+            if handle.strip().startswith("from:")
+        ]
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        response = web.StreamResponse()
+        await response.prepare(request)
+
+        # Drop the connection after a random time to force the bot to reconnect
+        end = time.monotonic() + random.uniform(0.5, 1.5) * self.disconnect_after
+        try:
+            await self.send_tweets(response, end)
+        except ConnectionResetError:
+            # The bot closed the stream first
+            return response
+
+        # The bot may have closed the connection meanwhile
+        if request.transport is not None:
+            request.transport.close()
+        return response
+
+    async def send_tweets(self, response: web.StreamResponse, end: float) -> None:
+        while time.monotonic() < end:
+            handles = [h for h in self.tracked_handles() if h in FAKE_USERS]
+            if len(handles) == 0:
+                await response.write(b"\r\n")
+            else:
+                handle = random.choice(handles)
+                tweet_id = str(next(self.tweet_ids))
+                line = {
+                    "data": {
+                        "id": tweet_id,
+                        "text": f"soak tweet {tweet_id} about {random.choice(['bitcoin', 'cats', 'rain'])}",
+                        "author_id": str(FAKE_USERS[handle]),
+                        "edit_history_tweet_ids": [tweet_id],
+                    },
+                    "includes": {
+                        "users": [
+                            {
+                                "id": str(FAKE_USERS[handle]),
+                                "name": handle,
+                                "username": handle,
+                                "profile_image_url": "https://example.com/avatar.png",
+                            }
+                        ]
+                    },
+                }
+                await response.write(json.dumps(line).encode() + b"\r\n")
+            await asyncio.sleep(self.tweet_interval)
+
+    async def get_rules(self, request: web.Request) -> web.Response:
+        data = [{"id": rule_id, "value": value} for rule_id, value in self.rules.items()]
+        return web.json_response({"data": data, "meta": {"result_count": len(data)}} if data else {"meta": {"result_count": 0}})
+
+    async def post_rules(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        for rule_id in body.get("delete", {}).get("ids", []):
+            self.rules.pop(str(rule_id), None)
+        added = []
+        for rule in body.get("add", []):
+            rule_id = str(next(self.rule_ids))
+            self.rules[rule_id] = rule["value"]
+            added.append({"id": rule_id, "value": rule["value"]})
+        return web.json_response({"data": added, "meta": {"summary": {"created": len(added)}}})
+
+    async def completion(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        answer = " Yes, it mentions bitcoin." if "bitcoin" in body["prompt"] else " No, it does not."
+        return web.json_response({"id": "soak", "object": "text_completion", "choices": [{"text": answer, "index": 0}]})
+
+    async def embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        vectors = local_embed(texts)
+        data = []
+        for i, vector in enumerate(vectors):
+            embedding = base64.b64encode(vector.tobytes()).decode() if body.get("encoding_format") == "base64" else vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        return web.json_response({"object": "list", "data": data, "model": body.get("model")})
+
+
+class FakeTwitterClient:
+    """
+    Stands in for the Twitter client the commands use to look up handles, knowing only the fake users.
+    """
+
+    def get_user(self, username: str) -> SimpleNamespace:
+        user_id = FAKE_USERS.get(username)
+        return SimpleNamespace(data=None if user_id is None else SimpleNamespace(id=user_id, username=username))
+
+
+def redirect_twitter_api(api_base: str) -> None:
+    """
+    Sends the requests aiohttp makes to the Twitter API to the fake one instead
+
+    Only the host is rewritten, so the stream and the rule requests go through tweepy's own code,
+    sessions included.
+    """
+    request = aiohttp.ClientSession._request
+
+    async def redirected_request(session, method, str_or_url, **kwargs):
+        url = str(str_or_url)
+        if url.startswith(TWITTER_API):
+            url = api_base + url[len(TWITTER_API):]
+        return await request(session, method, url, **kwargs)
+
+    aiohttp.ClientSession._request = redirected_request
+
+
+class FakeChannel:
+    """
+    Discord channel counting the messages sent to it.
+    """
+
+    def __init__(self, channel_id: int) -> None:
+        self.id = channel_id
+        self.guild = SimpleNamespace(id=GUILD_ID)
+        self.sent = 0
+
+    async def send(self, *args, **kwargs) -> None:
+        self.sent += 1
+
+
+class FakeBot:
+    """
+    Stands in for DiscordBot without connecting to the Discord gateway.
+    """
+
+    def __init__(self, channels) -> None:
+        self.channels = {channel.id: channel for channel in channels}
+        self.channel = self.channels[HOME_CHANNEL_ID]
+        self.stream = None
+        self.index = SubscriptionIndex(cnx)
+        self.history = MatchHistory(cnx)
+
+    def get_channel(self, channel_id: int) -> FakeChannel:
+        return self.channels.get(channel_id)
+
+    def create_stream(self) -> MyStreamListener:
+        return MyStreamListener(self, self.index, self.history, CURSOR)
+
+
+class FakeContext:
+    def __init__(self, channel: FakeChannel) -> None:
+        self.channel = channel
+        self.guild = channel.guild
+        self.message = SimpleNamespace(content="soak")
+
+    async def defer(self) -> None:
+        pass
+
+    async def send(self, *args, **kwargs) -> None:
+        await self.channel.send(*args, **kwargs)
+
+
+def count_stream_tasks() -> int:
+    """
+    Returns the number of running tasks reading a Twitter stream
+    """
+    return sum(
+        1
+        for task in asyncio.all_tasks()
+        if not task.done() and "_connect" in getattr(task.get_coro(), "__qualname__", "")
+    )
+
+
+def count_open_fds() -> int:
+    """
+    Returns the number of file descriptors, sockets included, opened by the process
+    """
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except FileNotFoundError:
+        return -1
+
+
+async def churn(bot: FakeBot, tracker: Tracker, interval: float) -> None:
+    """
+    Keeps issuing the commands of a busy admin session
+    """
+    channels = list(bot.channels.values())
+    while True:
+        await asyncio.sleep(random.expovariate(1 / interval))
+        ctx = FakeContext(random.choice(channels))
+        action = random.choice(["start", "stop", "stop_start", "add", "add", "remove", "list", "search", "disconnect"])
+
+        if action == "start":
+            await Tracker.start.callback(tracker, ctx)
+        elif action == "stop":
+            # Commands keep editing the rules while the stream is stopped until the next start
+            await Tracker.stop.callback(tracker, ctx)
+        elif action == "stop_start":
+            await Tracker.stop.callback(tracker, ctx)
+            await Tracker.start.callback(tracker, ctx)
+        elif action == "add":
+            question = random.choice(["Is it about bitcoin?", "Is it about cats?"])
+            try:
+                await Tracker.add_user.callback(tracker, ctx, random.choice(list(FAKE_USERS)), question)
+            except HandleAlreadyExist:
+                pass
+        elif action == "remove":
+            try:
+                await Tracker.remove_user.callback(tracker, ctx, random.choice(list(FAKE_USERS)))
+            except UserNotTracked:
+                pass
+        elif action == "list":
+            await Tracker.list.callback(tracker, ctx)
+        elif action == "search":
+            await Tracker.search.callback(tracker, ctx, "bitcoin")
+        elif action == "disconnect":
+            # Client side disconnection, the listener must reconnect on its own
+            bot.stream.disconnect()
+
+
+def grew(samples, tolerance: float) -> bool:
+    """
+    Check if the last quarter of the samples is above the highest sample of the second quarter by more than the tolerance
+
+    Tweets being classified come and go with the load, comparing with the highest sample keeps that noise from
+    being reported as a leak while a real leak still ends up above it on a long enough run.
+    """
+    quarter = max(len(samples) // 4, 1)
+    baseline = max(samples[quarter:2 * quarter])
+    final = statistics.median(samples[-quarter:])
+    return final > baseline + tolerance
+
+
+async def soak(args) -> int:
+    api_base = FakeServices(args.tweet_interval, args.disconnect_after).start()
+    redirect_twitter_api(api_base)
+    openai.api_base = f"{api_base}/v1"
+
+    # Commands look up handles among the fake users instead of calling Twitter
+    src.discordbot.TWITTER_CLIENT = FakeTwitterClient()
+
+    tracemalloc.start(10)
+    bot = FakeBot([FakeChannel(HOME_CHANNEL_ID), FakeChannel(2), FakeChannel(3)])
+    tracker = Tracker(bot)
+    await Tracker.start.callback(tracker, FakeContext(bot.channel))
+    churn_task = asyncio.create_task(churn(bot, tracker, args.churn_interval))
+
+    samples = {"tasks": [], "fds": [], "memory": []}
+    baseline_snapshot = None
+    violations = 0
+    started = time.monotonic()
+    while time.monotonic() - started < args.duration:
+        await asyncio.sleep(args.sample_interval)
+        bot.history.flush()
+        if churn_task.done():
+            churn_task.result()
+
+        stream_tasks = count_stream_tasks()
+        if stream_tasks > 1:
+            violations += 1
+            print(f"{stream_tasks} stream tasks running at once")
+
+        samples["tasks"].append(len(asyncio.all_tasks()))
+        samples["fds"].append(count_open_fds())
+        samples["memory"].append(tracemalloc.get_traced_memory()[0])
+        if baseline_snapshot is None and time.monotonic() - started > args.duration / 4:
+            baseline_snapshot = tracemalloc.take_snapshot()
+
+        print(
+            f"[{time.monotonic() - started:8.0f}s] tasks={samples['tasks'][-1]} fds={samples['fds'][-1]} "
+            f"memory={samples['memory'][-1] / 1e6:.1f}MB stream_tasks={stream_tasks} "
+            f"tweets_sent={sum(c.sent for c in bot.channels.values())} scheduler={dict(SCHEDULER.stats)} "
+            f"rules={dict(bot.stream.rules.stats)} matcher={dict(getattr(MATCHER, 'stats', {}))}"
+        )
+
+    churn_task.cancel()
+    await asyncio.gather(churn_task, return_exceptions=True)
+
+    failures = []
+    if violations > 0:
+        failures.append(f"more than one stream task was running in {violations} samples")
+    if grew(samples["tasks"], args.task_tolerance):
+        failures.append("live asyncio tasks kept growing")
+    if samples["fds"][0] >= 0 and grew(samples["fds"], args.fd_tolerance):
+        failures.append("open file descriptors kept growing")
+    if grew(samples["memory"], args.memory_tolerance * 1e6):
+        failures.append("traced memory kept growing")
+        if baseline_snapshot is not None:
+            for stat in tracemalloc.take_snapshot().compare_to(baseline_snapshot, "lineno")[:10]:
+                print(stat)
+
+    await bot.stream.close()
+    await SCHEDULER.close()
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    if len(failures) == 0:
+        print("PASS")
+    return 1 if failures else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Soak test the bot against fake Twitter, OpenAI and Discord endpoints")
+    parser.add_argument("--duration", type=float, default=3600, help="Length of the run in seconds")
+    parser.add_argument("--sample-interval", type=float, default=10, help="Seconds between resource samples")
+    parser.add_argument("--churn-interval", type=float, default=2, help="Mean seconds between admin commands")
+    parser.add_argument("--tweet-interval", type=float, default=0.2, help="Seconds between fake tweets")
+    parser.add_argument("--disconnect-after", type=float, default=30, help="Mean seconds before the fake stream drops")
+    parser.add_argument("--task-tolerance", type=float, default=10, help="Allowed growth of live tasks")
+    parser.add_argument("--fd-tolerance", type=float, default=10, help="Allowed growth of open file descriptors")
+    parser.add_argument("--memory-tolerance", type=float, default=20, help="Allowed growth of traced memory in MB")
+    try:
+        status = asyncio.run(soak(parser.parse_args()))
+    finally:
+        # Remove the scratch database
+        cnx.close()
+        os.chdir(ORIGINAL_DIR)
+        SCRATCH_DIR.cleanup()
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
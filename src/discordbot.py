@@ -1,10 +1,14 @@
 import re
+import time
 from typing import Tuple, List, Dict
 
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord.ext.commands.context import Context
-from .globals_ import CURSOR, cnx, TWITTER_CLIENT, TWITTER_HANDLE_REGEX, MAX_MESSAGE_LENGTH, DISCORD_CHANNEL_ID, handle_exist, InvalidHandle, HandleAlreadyExist, UserLimitReached, InvalidList, UserNotTracked
+from .globals_ import CURSOR, cnx, TWITTER_CLIENT, TWITTER_HANDLE_REGEX, MAX_MESSAGE_LENGTH, DISCORD_CHANNEL_ID, HISTORY_RETENTION_DAYS, handle_exist, InvalidHandle, HandleAlreadyExist, UserLimitReached, InvalidList, UserNotTracked, NotHomeAdmin
 from .twitterStream import *
+from .tenancy import SubscriptionIndex
+from .history import MatchHistory, HISTORY_PAGE_SIZE
+from .matchers import CascadeMatcher
 
 from . import discord_logger
 
@@ -15,9 +19,9 @@ intents.typing = False
 intents.presences = False
 
 
-def process_handles(handle: str) -> Tuple[str, int]:
+def lookup_handle(handle: str) -> Tuple[str, int]:
     """
-    Process a list of Twitter handles and return a list of valid handles.
+    Validate a Twitter handle and return it along with the id of the user.
 
     Parameters
     ----------
@@ -33,9 +37,6 @@ def process_handles(handle: str) -> Tuple[str, int]:
     ------
     InvalidHandle
     If the handle is invalid
-    
-    HandleAlreadyExist
-    If the handle already exists in the database
 
     """
 
@@ -48,11 +49,40 @@ def process_handles(handle: str) -> Tuple[str, int]:
     if user.data is None:
         raise InvalidHandle
 
-    if handle_exist(user.data.id):
-        raise HandleAlreadyExist(handle, user.data.id)
-
     return handle, user.data.id
 
+
+def process_handles(handle: str) -> Tuple[str, int]:
+    """
+    Process a list of Twitter handles and return a list of valid handles.
+
+    Parameters
+    ----------
+    handle : str
+    The handle to process
+
+    Returns
+    -------
+    tuple[str,int]
+    A tuple containing the handle and the id of a user.
+
+    Raises
+    ------
+    InvalidHandle
+    If the handle is invalid
+    
+    HandleAlreadyExist
+    If the handle already exists in the database
+
+    """
+
+    handle, user_id = lookup_handle(handle)
+
+    if handle_exist(user_id):
+        raise HandleAlreadyExist(handle, user_id)
+
+    return handle, user_id
+
 def process_twitter_list( list_id : str ) -> List[Dict] :
     """
     Process a Twitter list and return a list of valid handles.
@@ -127,37 +157,102 @@ async def load_database(stream: MyStreamListener, channel: discord.channel.TextC
     None
     """
 
-    CURSOR.execute("SELECT COUNT(*) FROM users")
-    count = CURSOR.fetchone()[0]
-    if count > 0:
+    CURSOR.execute("SELECT handle FROM users")
+    handles = [handle[0] for handle in CURSOR.fetchall()]
+    if len(handles) > 0:
         try:
-            CURSOR.execute("SELECT handle FROM users")
-            handles = [handle[0] for handle in CURSOR.fetchall()]
             await stream.load_handles_from_list(handles)
-            stream.custom_filter()
         except UserLimitReached:
             await channel.send("Users limit reached")
-            
-    stream.custom_filter()
+
+    await stream.restart()
+
+
+def remove_untracked_users() -> List[str]:
+    """
+    Remove the users no channel is subscribed to anymore from the database.
+
+    Returns
+    -------
+    list[str]
+    The handles of the removed users
+    """
+
+    CURSOR.execute("SELECT handle FROM users WHERE id NOT IN (SELECT user_id FROM subscriptions)")
+    handles = [handle[0] for handle in CURSOR.fetchall()]
+    CURSOR.execute("DELETE FROM users WHERE id NOT IN (SELECT user_id FROM subscriptions)")
+    cnx.commit()
+    return handles
+
+
+def is_home_admin():
+    """
+    Check allowing a command only to the bot owner and the administrators of the guild of the home channel.
+
+    Used on the commands that change the bot for every guild, such as the shared stream and the classification settings.
+    """
+
+    async def predicate(ctx: Context) -> bool:
+        if await ctx.bot.is_owner(ctx.author):
+            return True
+        if ctx.guild is None or ctx.bot.channel is None or ctx.guild.id != ctx.bot.channel.guild.id:
+            raise NotHomeAdmin
+        if not ctx.author.guild_permissions.administrator:
+            raise NotHomeAdmin
+        return True
+
+    return commands.check(predicate)
 
 
 class Tracker(commands.Cog):
     def __init__(self, bot: "DiscordBot") -> None:
         self.bot = bot
 
+    async def cog_load(self) -> None:
+        self.flush_history.start()
+        self.prune_history.start()
+
+    async def cog_unload(self) -> None:
+        self.flush_history.cancel()
+        self.prune_history.cancel()
+        self.bot.history.flush()
+
+    @tasks.loop(seconds=30)
+    async def flush_history(self):
+        # Write the tweets classified since the last flush
+        self.bot.history.flush()
+
+    @tasks.loop(hours=24)
+    async def prune_history(self):
+        deleted = self.bot.history.prune(HISTORY_RETENTION_DAYS)
+        discord_logger.info(f"Pruned {deleted} history records")
+
     @commands.hybrid_command(description="Add a new user to the database")
     async def add_user(self, ctx, handle: str, question: str):
 
         await ctx.defer()
-        handle, user_id = process_handles(handle)
-        await self.bot.stream.add_handle(handle)
+        handle, user_id = lookup_handle(handle)
 
-        # Add handle to the database
+        if self.bot.index.is_subscribed(ctx.channel.id, user_id):
+            raise HandleAlreadyExist(handle, user_id)
+
+        # Add handle to the database before waiting for the stream rules so that concurrent commands see it
         CURSOR.execute(
-            "INSERT INTO users (id, handle, question) VALUES (?, ?, ?)",
+            "INSERT OR IGNORE INTO users (id, handle, question) VALUES (?, ?, ?)",
             (user_id, handle, question),
         )
         cnx.commit()
+        # Direct messages have no guild
+        self.bot.index.subscribe(ctx.guild.id if ctx.guild else None, ctx.channel.id, user_id, question)
+
+        # The rule manager skips handles the stream already tracks
+        try:
+            await self.bot.stream.add_handle(handle)
+        except Exception:
+            self.bot.index.unsubscribe(ctx.channel.id, user_id)
+            remove_untracked_users()
+            raise
+
         await ctx.send(f"Tracking {handle} for question: {question}")
 
     @commands.hybrid_command(description="Add users from a twitter list to the database")
@@ -167,28 +262,32 @@ class Tracker(commands.Cog):
         members = process_twitter_list(list_id)
         valid_members=[]
         for member in members:
-            # Check if some users are not already in the database
-            if not handle_exist(member.id):
+            # Check if some users are not already tracked in this channel
+            if not self.bot.index.is_subscribed(ctx.channel.id, member.id):
                 valid_members.append(member)
         
         
         if(len(valid_members)==0):
             await ctx.send("All users are already in the database")
             return
-        
-        CURSOR.execute("SELECT handle FROM users")
-        handles = CURSOR.fetchall()
 
-        handles.extend([m.username for m in valid_members])
-        await self.bot.stream.load_handles_from_list(handles)
-        
         # Add handles to the database
         for member in valid_members:
             CURSOR.execute(
-                "INSERT INTO users (id, handle, question) VALUES (?, ?, ?)",
+                "INSERT OR IGNORE INTO users (id, handle, question) VALUES (?, ?, ?)",
                 (member.id, member.username, question),
             )
-            cnx.commit()
+        cnx.commit()
+        for member in valid_members:
+            self.bot.index.subscribe(ctx.guild.id if ctx.guild else None, ctx.channel.id, member.id, question)
+
+        try:
+            await self.bot.stream.add_handles([m.username for m in valid_members])
+        except Exception:
+            for member in valid_members:
+                self.bot.index.unsubscribe(ctx.channel.id, member.id)
+            remove_untracked_users()
+            raise
             
         await ctx.send(f"Tracking {len(valid_members)} users for question: {question}")
         
@@ -197,20 +296,19 @@ class Tracker(commands.Cog):
     async def remove_user(self, ctx, handle):
 
         await ctx.defer()
-        try:
-            handle, user_id = process_handles(handle)
+        handle, user_id = lookup_handle(handle)
 
-        except HandleAlreadyExist as e:
-            handle, user_id = e.handle, e.user_id
-            await self.bot.stream.remove_handle(handle)
+        if not self.bot.index.is_subscribed(ctx.channel.id, user_id):
+            raise UserNotTracked
 
-            # Remove handle from the database
-            CURSOR.execute("DELETE FROM users WHERE id = ?", (user_id,))
-            cnx.commit()
-            await ctx.send(f"Stopped tracking {handle}")
+        self.bot.index.unsubscribe(ctx.channel.id, user_id)
 
-        else:
-            raise UserNotTracked
+        # Stop streaming the user once no channel tracks it anymore
+        removed_handles = remove_untracked_users()
+        if len(removed_handles) > 0:
+            await self.bot.stream.remove_handles(removed_handles)
+
+        await ctx.send(f"Stopped tracking {handle}")
 
 
         
@@ -221,26 +319,22 @@ class Tracker(commands.Cog):
         members = process_twitter_list(list_id)
         valid_members=[]
         for member in members:
-            # Filter users who are not in the database
-            if handle_exist(member.id):
+            # Filter users who are not tracked in this channel
+            if self.bot.index.is_subscribed(ctx.channel.id, member.id):
                 valid_members.append(member)
         
         
         if(len(valid_members)==0):
             await ctx.send("No users from this list is in the database")
             return
-        
-        CURSOR.execute("SELECT handle FROM users")
-        handles = CURSOR.fetchall()
 
-        valid_handles = [m.username for m in valid_members]
-        updated_list = [handle for handle in handles if handle not in valid_handles]
-        await self.bot.stream.load_handles_from_list(updated_list)
-        
-        # Add handles to the database
         for member in valid_members:
-            CURSOR.execute("DELETE FROM users WHERE id = ?", (member.id,))
-            cnx.commit()
+            self.bot.index.unsubscribe(ctx.channel.id, member.id)
+
+        # Stop streaming the users once no channel tracks them anymore
+        removed_handles = remove_untracked_users()
+        if len(removed_handles) > 0:
+            await self.bot.stream.remove_handles(removed_handles)
 
         await ctx.send(f"Stopped tracking {len(valid_members)} users")
       
@@ -249,7 +343,10 @@ class Tracker(commands.Cog):
     )
     async def list(self, ctx):
         await ctx.defer()
-        CURSOR.execute("SELECT * FROM users")
+        CURSOR.execute(
+            "SELECT users.handle, subscriptions.question FROM subscriptions JOIN users ON users.id = subscriptions.user_id WHERE subscriptions.channel_id = ?",
+            (ctx.channel.id,),
+        )
         users = CURSOR.fetchall()
         await ctx.send(f"Currently tracking {len(users)} users")
 
@@ -260,8 +357,8 @@ class Tracker(commands.Cog):
         msg_list=[]
         msg = ""
         for user in users:
-            handle = user[1]
-            question = user[2]
+            handle = user[0]
+            question = user[1]
             if len(msg) + len(f"{handle}: {question}\n") >= MAX_MESSAGE_LENGTH:
                 msg_list.append(msg)
                 msg=""
@@ -273,18 +370,120 @@ class Tracker(commands.Cog):
 
         
 
+    @commands.hybrid_command(description="Search the tweets classified for this channel")
+    async def search(self, ctx, query: str, before: int = None, days: float = None, matches_only: bool = False):
+        await ctx.defer()
+        if not query.strip():
+            await ctx.send("Please provide words to search for")
+            return
+
+        since = time.time() - days * 86400 if days else None
+        results = self.bot.history.search(ctx.channel.id, query, before, since=since, match_only=matches_only)
+        await ctx.send(f"{len(results)} results for {query}")
+
+        if len(results) == 0:
+            return
+
+        # Print results in Discord channel
+        msg_list=[]
+        msg = ""
+        for _, handle, tweet_id, tweet_text, question, match, explanation, created_at in results:
+            line = f"<t:{int(created_at)}:f> https://twitter.com/{handle}/status/{tweet_id}\n{question}: {'Match' if match else 'No match'}\n"
+            if len(msg) + len(line) >= MAX_MESSAGE_LENGTH:
+                msg_list.append(msg)
+                msg=""
+            msg += line
+
+        # Older results continue from the last one shown
+        if len(results) == HISTORY_PAGE_SIZE:
+            msg += f"More results with before: {results[-1][0]}\n"
+
+        msg_list.append(msg)
+        for msg in msg_list:
+            await ctx.send(msg)
+
+    @commands.hybrid_command(description="Set the similarity threshold of a question for the embedding engine")
+    @is_home_admin()
+    async def set_threshold(self, ctx, question: str, threshold: float):
+        await ctx.defer()
+        CURSOR.execute(
+            "INSERT INTO question_thresholds (question, threshold) VALUES (?, ?) ON CONFLICT (question) DO UPDATE SET threshold = excluded.threshold",
+            (question, threshold),
+        )
+        cnx.commit()
+        await ctx.send(f"Threshold for question: {question} set to {threshold}")
+
+    @commands.hybrid_command(description="Set the confidence the fast model of the cascade engine needs for a question")
+    @is_home_admin()
+    async def set_confidence(self, ctx, question: str, confidence: float):
+        await ctx.defer()
+        CURSOR.execute(
+            "INSERT INTO question_thresholds (question, confidence) VALUES (?, ?) ON CONFLICT (question) DO UPDATE SET confidence = excluded.confidence",
+            (question, confidence),
+        )
+        cnx.commit()
+        await ctx.send(f"Confidence for question: {question} set to {confidence}")
+
+    @commands.hybrid_command(description="Show the escalation rate and agreement of the cascade engine")
+    async def cascade_stats(self, ctx):
+        if not isinstance(MATCHER, CascadeMatcher):
+            await ctx.send("The cascade engine is not enabled")
+            return
+        await ctx.send(MATCHER.summary())
+
+    @commands.hybrid_command(description="Set the classification priority and optionally the max staleness in seconds of a user, 0 removes it")
+    @is_home_admin()
+    async def set_priority(self, ctx, handle: str, priority: int, max_staleness: float = None):
+        await ctx.defer()
+        handle, user_id = lookup_handle(handle)
+
+        if not handle_exist(user_id):
+            raise UserNotTracked
+
+        # The max staleness is kept unless given, 0 removes it
+        if max_staleness is None:
+            CURSOR.execute("UPDATE users SET priority = ? WHERE id = ?", (max(priority, 1), user_id))
+        else:
+            CURSOR.execute(
+                "UPDATE users SET priority = ?, max_staleness = ? WHERE id = ?",
+                (max(priority, 1), max_staleness if max_staleness > 0 else None, user_id),
+            )
+        cnx.commit()
+
+        CURSOR.execute("SELECT max_staleness FROM users WHERE id = ?", (user_id,))
+        max_staleness = CURSOR.fetchone()[0]
+        await ctx.send(f"Priority of {handle} set to {max(priority, 1)}, max staleness: {max_staleness or 'none'}")
+
+    @commands.hybrid_command(description="Show the classification backlog and the tweets shed under load")
+    async def queue(self, ctx):
+        stats = SCHEDULER.stats
+        await ctx.send(
+            f"Backlog: {SCHEDULER.backlog}\n"
+            f"Submitted: {stats['submitted']}\n"
+            f"Classified: {stats['classified']}\n"
+            f"Degraded to prefilter: {stats['degraded']}\n"
+            f"Dropped (stale): {stats['dropped_stale']}\n"
+            f"Dropped (overflow): {stats['dropped_overflow']}"
+        )
+
     @commands.hybrid_command(description="Start the bot")
+    @is_home_admin()
     async def start(self, ctx):
         # Start the bot
         await ctx.send("Starting bot")
-        self.bot.stream = MyStreamListener(self.bot.channel, CURSOR)
+        # Close the previous stream so that its task and session don't outlive it
+        if self.bot.stream is not None:
+            await self.bot.stream.close()
+        self.bot.stream = self.bot.create_stream()
         await load_database(self.bot.stream, self.bot.channel)
 
     @commands.hybrid_command(description="Stop the bot")
+    @is_home_admin()
     async def stop(self, ctx):
         # Stop the bot
         await ctx.send("Stopping bot")
-        self.bot.stream.disconnect()
+        if self.bot.stream is not None:
+            await self.bot.stream.close()
 
     @commands.hybrid_command(name="help", description="Show help for the bot")
     async def help(self, ctx):
@@ -306,6 +505,11 @@ class DiscordBot(commands.Bot):
         super().__init__(*args, **kwargs, help_command=None)
         self.channel = None
         self.stream = None
+        self.index = SubscriptionIndex(cnx)
+        self.history = MatchHistory(cnx)
+
+    def create_stream(self) -> MyStreamListener:
+        return MyStreamListener(self, self.index, self.history, CURSOR)
 
     async def setup_hook(self) -> None:
         tracker = Tracker(self)
@@ -318,17 +522,21 @@ class DiscordBot(commands.Bot):
         if self.channel is None:
             self.channel = self.get_channel(DISCORD_CHANNEL_ID)
             MY_GUILD = self.channel.guild
+            # Subscriptions migrated from the users table were stored before the home guild was known
+            self.index.fill_guild(self.channel.id, MY_GUILD.id)
             self.tree.copy_global_to(guild=MY_GUILD)
             await self.tree.sync(guild=MY_GUILD)
+            # Other guilds subscribe through the global commands
+            await self.tree.sync()
             await self.channel.send(embed=create_start_message())
 
         if self.stream is None:
-            self.stream = MyStreamListener(self.channel, CURSOR)
+            self.stream = self.create_stream()
             await load_database(self.stream, self.channel)
 
     async def on_command_error(self, ctx: Context, exception: Exception) -> None:
         #print(exception)
         discord_logger.exception(exception)
-        await self.channel.send(
+        await ctx.send(
             embed=create_error_embed(ctx.message.content, exception)
         )
\ No newline at end of file
@@ -20,6 +20,37 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 # Set up connection to OpenAI API
 openai.api_key = OPENAI_API_KEY
 
+# Get the engine used to match tweets against questions ("completion", "embedding" or "cascade")
+MATCHER_ENGINE = os.environ.get("MATCHER_ENGINE", "completion").lower()
+
+# Get the embedding model from the environment variables ("local" uses the offline hashing embedder)
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-ada-002")
+
+# Default cosine similarity a tweet must reach to match a question. The offline hashing embedder only scores
+# shared words, so even obvious matches stay far below the scores of OpenAI embeddings
+EMBEDDING_THRESHOLD = float(os.environ.get("EMBEDDING_THRESHOLD", "0.22" if EMBEDDING_MODEL == "local" else "0.80"))
+
+# Scores within this distance of the threshold are sent to the completion engine
+EMBEDDING_BORDERLINE_MARGIN = float(os.environ.get("EMBEDDING_BORDERLINE_MARGIN", "0.03"))
+
+# Fast model answering first with the cascade engine ("local" uses the offline embedding similarity)
+CASCADE_FAST_MODEL = os.environ.get("CASCADE_FAST_MODEL", "text-curie-001")
+
+# Default confidence the fast model needs to answer without escalating to text-davinci-003
+CASCADE_CONFIDENCE = float(os.environ.get("CASCADE_CONFIDENCE", "0.90"))
+
+# Share of confident answers also checked by text-davinci-003 to measure agreement
+CASCADE_AUDIT_RATE = float(os.environ.get("CASCADE_AUDIT_RATE", "0.02"))
+
+# Number of days classified tweets are kept in the history table
+HISTORY_RETENTION_DAYS = int(os.environ.get("HISTORY_RETENTION_DAYS", "30"))
+
+# Number of classification requests in flight, a request holds a batch of tweets with batching matchers
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", "4"))
+
+# Number of queued tweets above which the ones served last are degraded to the prefilter
+SCHEDULER_MAX_BACKLOG = int(os.environ.get("SCHEDULER_MAX_BACKLOG", "200"))
+
 # Get the Discord Bot Token from the environment variables
 DISCORD_BOT_TOKEN = os.environ.get("DISCORD_BOT_TOKEN")
 
@@ -35,6 +66,61 @@ CURSOR.execute(
     """CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, handle TEXT, question TEXT )"""
 )
 
+# add the scheduling priority and max staleness in seconds of each user to databases created before they existed
+CURSOR.execute("PRAGMA table_info(users)")
+USER_COLUMNS = [column[1] for column in CURSOR.fetchall()]
+if "priority" not in USER_COLUMNS:
+    CURSOR.execute("ALTER TABLE users ADD COLUMN priority INTEGER DEFAULT 1")
+if "max_staleness" not in USER_COLUMNS:
+    CURSOR.execute("ALTER TABLE users ADD COLUMN max_staleness REAL")
+
+# create table containing the subscriptions of discord channels to twitter users and questions
+CURSOR.execute(
+    """CREATE TABLE IF NOT EXISTS subscriptions (guild_id INTEGER, channel_id INTEGER, user_id INTEGER, question TEXT, PRIMARY KEY (channel_id, user_id, question) )"""
+)
+
+# Databases created before subscriptions existed track every user for the home channel
+CURSOR.execute("SELECT COUNT(*) FROM subscriptions")
+if CURSOR.fetchone()[0] == 0:
+    CURSOR.execute(
+        "INSERT INTO subscriptions (channel_id, user_id, question) SELECT ?, id, question FROM users",
+        (DISCORD_CHANNEL_ID,),
+    )
+    cnx.commit()
+
+# create table containing the similarity threshold of each question for the embedding engine
+CURSOR.execute(
+    """CREATE TABLE IF NOT EXISTS question_thresholds (question TEXT PRIMARY KEY, threshold REAL )"""
+)
+
+# add the confidence the cascade fast model needs for each question to databases created before it existed
+CURSOR.execute("PRAGMA table_info(question_thresholds)")
+if "confidence" not in [column[1] for column in CURSOR.fetchall()]:
+    CURSOR.execute("ALTER TABLE question_thresholds ADD COLUMN confidence REAL")
+
+# create table containing every classified tweet with its question and verdict
+CURSOR.execute(
+    """CREATE TABLE IF NOT EXISTS history (id INTEGER PRIMARY KEY, tweet_id INTEGER, author_id INTEGER, handle TEXT, tweet_text TEXT, question TEXT, match INTEGER, explanation TEXT, latency REAL, created_at REAL )"""
+)
+CURSOR.execute("CREATE INDEX IF NOT EXISTS history_created_at ON history (created_at)")
+CURSOR.execute("CREATE INDEX IF NOT EXISTS history_author ON history (author_id, created_at)")
+
+# create full-text index on the history, kept in sync by triggers
+CURSOR.execute(
+    """CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(tweet_text, question, explanation, content='history', content_rowid='id')"""
+)
+CURSOR.execute(
+    """CREATE TRIGGER IF NOT EXISTS history_insert AFTER INSERT ON history BEGIN
+    INSERT INTO history_fts (rowid, tweet_text, question, explanation) VALUES (new.id, new.tweet_text, new.question, new.explanation);
+    END"""
+)
+CURSOR.execute(
+    """CREATE TRIGGER IF NOT EXISTS history_delete AFTER DELETE ON history BEGIN
+    INSERT INTO history_fts (history_fts, rowid, tweet_text, question, explanation) VALUES ('delete', old.id, old.tweet_text, old.question, old.explanation);
+    END"""
+)
+cnx.commit()
+
 TWITTER_CLIENT = tweepy.Client(bearer_token=TWITTER_BEARER_TOKEN)
 
 # Regular expression for validating Twitter handles. A Twitter
@@ -96,6 +182,23 @@ class UserNotTracked(HandleProcessingException):
     def __init__(self):
         super().__init__("User is not currently tracked")
 
+class NotHomeAdmin(commands.CheckFailure):
+    """
+    Exception raised when a command changing the bot for every server is used by someone else than the bot owner or an administrator of the home server.
+    """
+
+    def __init__(self):
+        super().__init__("Only the bot owner and the administrators of the home server can use this command")
+
+class RuleUpdateFailed(Exception):
+    """
+    Exception raised when Twitter rejects an update of the stream rules.
+    """
+
+    def __init__(self, errors: list) -> None:
+        super().__init__(f"Stream rules update failed: {errors}")
+        self.errors = errors
+
 class InvalidList(Exception):
     """
     Exception raised when a Twitter list id is invalid.
@@ -0,0 +1,187 @@
+import time
+from sqlite3 import Connection
+from typing import List, Optional, Tuple
+
+# Number of buffered records that triggers a write to the database
+HISTORY_BATCH_SIZE = 100
+
+# Number of rows deleted per statement when pruning the history
+HISTORY_PRUNE_CHUNK = 5000
+
+# Number of results per page of the search command
+HISTORY_PAGE_SIZE = 10
+
+
+def build_fts_query(query: str) -> str:
+    """
+    Quotes every word of a user query so that FTS5 operators in it are matched literally
+    """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+class MatchHistory:
+    """
+    History of classified tweets stored in the history table of the database.
+
+    Records are buffered in memory and written in batches, either when HISTORY_BATCH_SIZE
+    records are waiting or when flush is called.
+    """
+
+    def __init__(self, cnx: Connection) -> None:
+        self.cnx = cnx
+        self.cursor = cnx.cursor()
+        self.buffer: List[Tuple] = []
+
+    def record(
+        self,
+        tweet_id: int,
+        author_id: int,
+        handle: str,
+        tweet_text: str,
+        question: str,
+        match: bool,
+        explanation: str,
+        latency: float,
+    ) -> None:
+        """
+        Adds a classified tweet to the history
+
+        Parameters
+        ----------
+        tweet_id : int
+        The id of the tweet
+
+        author_id : int
+        The id of the author of the tweet
+
+        handle : str
+        The handle of the author of the tweet
+
+        tweet_text : str
+        The text of the tweet
+
+        question : str
+        The question the tweet was checked against
+
+        match : bool
+        Whether the tweet matched the question
+
+        explanation : str
+        The answer of the matcher
+
+        latency : float
+        The time in seconds the classification took
+
+        Returns
+        -------
+        None
+        """
+
+        self.buffer.append(
+            (tweet_id, author_id, handle, tweet_text, question, int(match), explanation, latency, time.time())
+        )
+        if len(self.buffer) >= HISTORY_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered records to the database in a single transaction
+        """
+        if len(self.buffer) == 0:
+            return
+
+        buffer, self.buffer = self.buffer, []
+        with self.cnx:
+            self.cursor.executemany(
+                "INSERT INTO history (tweet_id, author_id, handle, tweet_text, question, match, explanation, latency, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                buffer,
+            )
+
+    def prune(self, retention_days: int) -> int:
+        """
+        Deletes the records older than the retention period, HISTORY_PRUNE_CHUNK rows at a time
+
+        Parameters
+        ----------
+        retention_days : int
+        The number of days records are kept
+
+        Returns
+        -------
+        int
+        The number of deleted records
+        """
+
+        cutoff = time.time() - retention_days * 86400
+        deleted = 0
+        while True:
+            with self.cnx:
+                self.cursor.execute(
+                    "DELETE FROM history WHERE id IN (SELECT id FROM history WHERE created_at < ? LIMIT ?)",
+                    (cutoff, HISTORY_PRUNE_CHUNK),
+                )
+            deleted += self.cursor.rowcount
+            if self.cursor.rowcount < HISTORY_PRUNE_CHUNK:
+                return deleted
+
+    def search(
+        self,
+        channel_id: int,
+        query: str,
+        before: Optional[int] = None,
+        since: Optional[float] = None,
+        match_only: bool = False,
+    ) -> List[Tuple]:
+        """
+        Searches the history of the users and questions a channel is subscribed to
+
+        Parameters
+        ----------
+        channel_id : int
+        The id of the channel searching
+
+        query : str
+        The words to look for in the tweet, question or explanation
+
+        before : int, optional
+        Only return records with an id lower than this one, the id of the last record of the previous page
+
+        since : float, optional
+        Only return records created after this timestamp
+
+        match_only : bool
+        Only return the tweets that matched their question
+
+        Returns
+        -------
+        list[tuple]
+        At most HISTORY_PAGE_SIZE rows of (id, handle, tweet_id, tweet_text, question, match, explanation, created_at),
+        newest first
+        """
+
+        # An empty FTS5 query is a syntax error
+        fts_query = build_fts_query(query)
+        if not fts_query:
+            return []
+
+        # Write pending records so that they can be found
+        self.flush()
+
+        # FTS5 returns its rows in rowid order, ordering by it stops at the page limit instead of sorting every match.
+        # Pages continue from the last id seen instead of an offset so that deep pages are as fast as the first one
+        self.cursor.execute(
+            """SELECT history.id, history.handle, history.tweet_id, history.tweet_text, history.question, history.match, history.explanation, history.created_at
+            FROM history_fts JOIN history ON history.id = history_fts.rowid
+            WHERE history_fts MATCH ? AND history_fts.rowid < ? AND history.created_at >= ? AND history.match >= ?
+            AND EXISTS (SELECT 1 FROM subscriptions WHERE subscriptions.channel_id = ? AND subscriptions.user_id = history.author_id AND subscriptions.question = history.question)
+            ORDER BY history_fts.rowid DESC LIMIT ?""",
+            (
+                fts_query,
+                before or 2 ** 63 - 1,
+                since or 0,
+                int(match_only),
+                channel_id,
+                HISTORY_PAGE_SIZE,
+            ),
+        )
+        return self.cursor.fetchall()
@@ -0,0 +1,561 @@
+import asyncio
+import functools
+import hashlib
+import math
+import random
+import re
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from sqlite3 import Cursor
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .globals_ import (
+    GPT_QUERY_BASE,
+    openai,
+    EMBEDDING_MODEL,
+    EMBEDDING_THRESHOLD,
+    EMBEDDING_BORDERLINE_MARGIN,
+    CASCADE_FAST_MODEL,
+    CASCADE_CONFIDENCE,
+    CASCADE_AUDIT_RATE,
+)
+
+from . import tweepy_logger
+
+# Dimension of the vectors produced by the local hashing embedder
+LOCAL_EMBEDDING_DIM = 512
+
+# Max number of texts sent in a single embedding request
+EMBEDDING_BATCH_SIZE = 64
+
+# Time in seconds the embedding engine waits to group incoming tweets into one batch
+EMBEDDING_BATCH_WINDOW = 0.05
+
+# Number of strong model verdicts of a question needed before similarity scores are trusted in the cascade
+CALIBRATION_MIN_SAMPLES = 30
+
+# Number of strong model Yes and of strong model No a question needs before its scores are trusted, so that rare
+# matches are escalated until the calibration has seen some of them
+CALIBRATION_MIN_CLASS_SAMPLES = 5
+
+# Number of most recent strong model verdicts each question is calibrated on
+CALIBRATION_WINDOW = 500
+
+# Strength of the prior pulling the calibrated probabilities towards 0.5 when there are few verdicts
+CALIBRATION_PRIOR = 1.0
+
+# Number of recent similarity scores kept to be paired with the strong model verdict
+RECENT_SCORES_SIZE = 1024
+
+
+async def run_blocking(func: Callable, *args, **kwargs):
+    """
+    Runs a blocking call, such as an OpenAI request, in a thread so that the event loop keeps running
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+class Matcher(ABC):
+    """
+    Base class of the engines used to check if a tweet matches a question.
+    """
+
+    # Number of tweets the matcher checks together in one request
+    batch_size = 1
+
+    @abstractmethod
+    async def match(self, tweet_text: str, question: str) -> List[Union[bool, str]]:
+        """
+        Checks if the tweet text matches the question
+
+        Parameters
+        ----------
+        tweet_text : str
+        The text of the tweet
+
+        question : str
+        The question to check for
+
+        Returns
+        -------
+        list[bool,str]
+        A list containing a boolean value indicating if the tweet text match the question and the explanation
+        """
+
+    async def match_with_confidence(self, tweet_text: str, question: str) -> Tuple[List[Union[bool, str]], float]:
+        """
+        Checks if the tweet text matches the question and how confident the matcher is
+
+        Parameters
+        ----------
+        tweet_text : str
+        The text of the tweet
+
+        question : str
+        The question to check for
+
+        Returns
+        -------
+        tuple[list[bool,str],float]
+        The verdict and a confidence between 0.5 and 1, matchers unable to tell are always confident
+        """
+        return await self.match(tweet_text, question), 1.0
+
+    def record_outcome(self, tweet_text: str, question: str, match: bool) -> None:
+        """
+        Receives the verdict of a stronger matcher for a tweet this matcher answered, used to calibrate its confidence
+        """
+
+
+class CompletionMatcher(Matcher):
+    """
+    Matcher asking a completion model to answer the question for each tweet.
+    """
+
+    def __init__(self, engine: str = "text-davinci-003") -> None:
+        self.engine = engine
+
+    async def match(self, tweet_text: str, question: str) -> List[Union[bool, str]]:
+        # Construct the query by combining the question and tweet text
+        query = GPT_QUERY_BASE.format(tweet=tweet_text, question=question)
+
+        # Use OpenAI API to check tweet for match with question
+        response = await run_blocking(
+            openai.Completion.create,
+            engine=self.engine,
+            prompt=query,
+            max_tokens=2048,
+            temperature=0.5,
+            top_p=1,
+            frequency_penalty=0,
+            presence_penalty=0,
+        )
+
+        # Extract answer from API response
+        answer = response["choices"][0]["text"].strip().lower()
+
+        # Return a list indicating if "yes" is in the answer and the answer itself
+        return ["yes" in answer, answer]
+
+    async def match_with_confidence(self, tweet_text: str, question: str) -> Tuple[List[Union[bool, str]], float]:
+        query = GPT_QUERY_BASE.format(tweet=tweet_text, question=question)
+
+        # Greedy answer with the log probabilities of the most likely tokens
+        response = await run_blocking(
+            openai.Completion.create,
+            engine=self.engine,
+            prompt=query,
+            max_tokens=64,
+            temperature=0,
+            logprobs=5,
+        )
+
+        choice = response["choices"][0]
+        answer = choice["text"].strip().lower()
+        return ["yes" in answer, answer], answer_confidence(choice["logprobs"])
+
+
+def answer_confidence(logprobs: dict) -> float:
+    """
+    Computes the confidence of a Yes or No answer from the log probabilities of its first word
+
+    Parameters
+    ----------
+    logprobs : dict
+    The logprobs of a completion choice
+
+    Returns
+    -------
+    float
+    The probability of the most likely of Yes and No, normalized over both, 0 if neither was likely
+    """
+
+    for token, top in zip(logprobs["tokens"], logprobs["top_logprobs"]):
+        # The answer starts at the first token that isn't whitespace
+        if not token.strip():
+            continue
+        p_yes = sum(math.exp(lp) for t, lp in top.items() if t.strip().lower() == "yes")
+        p_no = sum(math.exp(lp) for t, lp in top.items() if t.strip().lower() == "no")
+        if p_yes + p_no == 0:
+            return 0.0
+        return max(p_yes, p_no) / (p_yes + p_no)
+    return 0.0
+
+
+def local_embed(texts: List[str]) -> np.ndarray:
+    """
+    Embeds texts offline by hashing their words and word bigrams into a fixed size vector
+
+    Parameters
+    ----------
+    texts : list[str]
+    The texts to embed
+
+    Returns
+    -------
+    np.ndarray
+    A (len(texts), LOCAL_EMBEDDING_DIM) matrix of L2 normalized vectors
+    """
+
+    vectors = np.zeros((len(texts), LOCAL_EMBEDDING_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = re.findall(r"\w+", text.lower())
+        for token in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = hashlib.blake2b(token.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % LOCAL_EMBEDDING_DIM
+            sign = 1.0 if digest[4] & 1 else -1.0
+            vectors[row, bucket] += sign
+    return normalize_rows(vectors)
+
+
+def openai_embed(texts: List[str], model: str = EMBEDDING_MODEL) -> np.ndarray:
+    """
+    Embeds texts with the OpenAI embedding API, EMBEDDING_BATCH_SIZE texts per request
+
+    Parameters
+    ----------
+    texts : list[str]
+    The texts to embed
+
+    model : str
+    The OpenAI embedding model
+
+    Returns
+    -------
+    np.ndarray
+    A (len(texts), dim) matrix of L2 normalized vectors
+    """
+
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        response = openai.Embedding.create(input=texts[start:start + EMBEDDING_BATCH_SIZE], model=model)
+        data = sorted(response["data"], key=lambda item: item["index"])
+        vectors.extend(item["embedding"] for item in data)
+    return normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+
+class ScoreCalibration:
+    """
+    Maps the similarity scores of a question to the probability that the strong model answers Yes.
+
+    A logistic regression is fitted on the most recent (score, verdict) pairs of the question. The
+    prior keeps the probabilities away from 0 and 1 while there are few verdicts.
+    """
+
+    def __init__(self) -> None:
+        self.samples: Deque[Tuple[float, bool]] = deque(maxlen=CALIBRATION_WINDOW)
+        self.weights: Optional[np.ndarray] = None
+        self.mean = 0.0
+        self.std = 1.0
+
+    def add(self, score: float, match: bool) -> None:
+        self.samples.append((score, match))
+        # Refitted on the next lookup
+        self.weights = None
+
+    @property
+    def ready(self) -> bool:
+        matches = sum(match for _, match in self.samples)
+        return (
+            len(self.samples) >= CALIBRATION_MIN_SAMPLES
+            and min(matches, len(self.samples) - matches) >= CALIBRATION_MIN_CLASS_SAMPLES
+        )
+
+    def fit(self) -> None:
+        """
+        Fits the logistic regression with a few Newton steps on the standardized scores
+        """
+        scores = np.array([score for score, _ in self.samples])
+        labels = np.array([match for _, match in self.samples], dtype=np.float64)
+        self.mean = scores.mean()
+        self.std = scores.std() or 1.0
+        features = np.column_stack([(scores - self.mean) / self.std, np.ones_like(scores)])
+
+        weights = np.zeros(2)
+        for _ in range(25):
+            probabilities = 1 / (1 + np.exp(-features @ weights))
+            gradient = features.T @ (probabilities - labels) + CALIBRATION_PRIOR * weights
+            hessian = (features.T * probabilities * (1 - probabilities)) @ features + CALIBRATION_PRIOR * np.eye(2)
+            weights -= np.linalg.solve(hessian, gradient)
+        self.weights = weights
+
+    def probability(self, score: float) -> float:
+        """
+        Returns the probability that the strong model answers Yes for a similarity score
+        """
+        if self.weights is None:
+            self.fit()
+        logit = self.weights[0] * (score - self.mean) / self.std + self.weights[1]
+        return float(1 / (1 + np.exp(-logit)))
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Scales every row of a matrix to unit length so that dot products are cosine similarities
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class EmbeddingMatcher(Matcher):
+    """
+    Matcher scoring tweets against questions by cosine similarity of their embeddings.
+
+    Questions are embedded once and cached. Tweets arriving within EMBEDDING_BATCH_WINDOW, up to
+    EMBEDDING_BATCH_SIZE of them, are embedded in a single call and scored against every question
+    with one matrix multiply. Scores close to the question threshold are settled by the fallback matcher.
+
+    In the cascade the threshold isn't used. The confidence is the probability, learned per question
+    from the verdicts of the strong model, that the strong model gives the same answer, and it is
+    0 until CALIBRATION_MIN_SAMPLES verdicts, with CALIBRATION_MIN_CLASS_SAMPLES of both answers, were
+    collected so that every tweet is escalated.
+    """
+
+    batch_size = EMBEDDING_BATCH_SIZE
+
+    def __init__(
+        self,
+        cursor: Cursor,
+        embed: Optional[Callable[[List[str]], np.ndarray]] = None,
+        fallback: Optional[Matcher] = None,
+        threshold: float = EMBEDDING_THRESHOLD,
+        margin: float = EMBEDDING_BORDERLINE_MARGIN,
+    ) -> None:
+        if embed is None:
+            embed = local_embed if EMBEDDING_MODEL == "local" else openai_embed
+        self.cursor = cursor
+        self.embed = embed
+        self.fallback = fallback
+        self.threshold = threshold
+        self.margin = margin
+
+        self.question_index: Dict[str, int] = {}
+        self.question_matrix: Optional[np.ndarray] = None
+        self.pending: List[Tuple[str, str, asyncio.Future]] = []
+        self.flush_task: Optional[asyncio.Task] = None
+        self.batch_full: Optional[asyncio.Event] = None
+        self.calibration: Dict[str, ScoreCalibration] = {}
+        self.recent_scores: OrderedDict = OrderedDict()
+        self.stats = Counter()
+
+    def get_threshold(self, question: str) -> float:
+        """
+        Returns the similarity threshold of a question, falling back to the default threshold
+        """
+        self.cursor.execute("SELECT threshold FROM question_thresholds WHERE question = ?", (question,))
+        row = self.cursor.fetchone()
+        return self.threshold if row is None or row[0] is None else row[0]
+
+    async def embed_questions(self, questions: List[str]) -> None:
+        """
+        Embeds the questions that are not cached yet and appends them to the question matrix
+        """
+        new_questions = [q for q in dict.fromkeys(questions) if q not in self.question_index]
+        if len(new_questions) == 0:
+            return
+
+        vectors = await run_blocking(self.embed, new_questions)
+        for question, vector in zip(new_questions, vectors):
+            # Another batch may have embedded the question meanwhile
+            if question in self.question_index:
+                continue
+            self.question_index[question] = len(self.question_index)
+            if self.question_matrix is None:
+                self.question_matrix = vector[np.newaxis]
+            else:
+                self.question_matrix = np.vstack([self.question_matrix, vector])
+
+    async def score(self, tweet_texts: List[str], questions: List[str]) -> np.ndarray:
+        """
+        Scores every tweet against every question
+
+        Parameters
+        ----------
+        tweet_texts : list[str]
+        The texts of the tweets
+
+        questions : list[str]
+        The questions to score against
+
+        Returns
+        -------
+        np.ndarray
+        A (len(tweet_texts), len(questions)) matrix of cosine similarities
+        """
+
+        await self.embed_questions(questions)
+        tweet_matrix = await run_blocking(self.embed, tweet_texts)
+        columns = [self.question_index[q] for q in questions]
+        return tweet_matrix @ self.question_matrix[columns].T
+
+    async def similarity(self, tweet_text: str, question: str) -> float:
+        """
+        Returns the cosine similarity of a tweet and a question, computed with the batch of pending tweets
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((tweet_text, question, future))
+        if self.flush_task is None:
+            self.batch_full = asyncio.Event()
+            self.flush_task = asyncio.create_task(self.flush(self.batch_full))
+        # Full batches don't wait for the end of the window
+        if len(self.pending) >= self.batch_size:
+            self.batch_full.set()
+        return await future
+
+    async def match_with_confidence(self, tweet_text: str, question: str) -> Tuple[List[Union[bool, str]], float]:
+        score = await self.similarity(tweet_text, question)
+
+        # Remember the score until the strong model verdict comes back
+        self.recent_scores[(tweet_text, question)] = score
+        if len(self.recent_scores) > RECENT_SCORES_SIZE:
+            self.recent_scores.popitem(last=False)
+
+        calibration = self.calibration.get(question)
+        if calibration is None or not calibration.ready:
+            return [False, f"similarity {score:.3f} (uncalibrated)"], 0.0
+
+        probability = calibration.probability(score)
+        return [probability >= 0.5, f"similarity {score:.3f} (match probability {probability:.2f})"], max(probability, 1 - probability)
+
+    def record_outcome(self, tweet_text: str, question: str, match: bool) -> None:
+        score = self.recent_scores.pop((tweet_text, question), None)
+        if score is not None:
+            self.calibration.setdefault(question, ScoreCalibration()).add(score, match)
+
+    async def match(self, tweet_text: str, question: str) -> List[Union[bool, str]]:
+        score = await self.similarity(tweet_text, question)
+        threshold = self.get_threshold(question)
+
+        # Borderline scores are settled by the fallback matcher
+        if self.fallback is not None and abs(score - threshold) < self.margin:
+            tweepy_logger.info(f"Borderline similarity {score:.3f} for question: {question}")
+            return await self.fallback.match(tweet_text, question)
+
+        return [score >= threshold, f"similarity {score:.3f} (threshold {threshold:.2f})"]
+
+    async def flush(self, batch_full: asyncio.Event) -> None:
+        """
+        Scores every pending (tweet, question) pair in one batch and resolves their futures
+        """
+        try:
+            await asyncio.wait_for(batch_full.wait(), EMBEDDING_BATCH_WINDOW)
+        except asyncio.TimeoutError:
+            pass
+        pending, self.pending = self.pending, []
+        self.flush_task = None
+
+        tweets = list(dict.fromkeys(text for text, _, _ in pending))
+        questions = list(dict.fromkeys(question for _, question, _ in pending))
+        self.stats["batches"] += 1
+        self.stats["tweets"] += len(tweets)
+        try:
+            scores = await self.score(tweets, questions)
+        except Exception as e:
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        rows = {text: i for i, text in enumerate(tweets)}
+        columns = {question: j for j, question in enumerate(questions)}
+        for text, question, future in pending:
+            if not future.done():
+                future.set_result(float(scores[rows[text], columns[question]]))
+
+
+class CascadeMatcher(Matcher):
+    """
+    Matcher asking a fast model first and escalating to a strong model when the fast one isn't confident.
+
+    A small share of the confident answers is also checked by the strong model to measure how often both agree.
+    """
+
+    def __init__(
+        self,
+        cursor: Cursor,
+        fast: Matcher,
+        strong: Matcher,
+        confidence: float = CASCADE_CONFIDENCE,
+        audit_rate: float = CASCADE_AUDIT_RATE,
+    ) -> None:
+        self.cursor = cursor
+        self.fast = fast
+        self.strong = strong
+        self.confidence = confidence
+        self.audit_rate = audit_rate
+        self.batch_size = fast.batch_size
+        self.stats = Counter()
+
+    def get_confidence(self, question: str) -> float:
+        """
+        Returns the confidence the fast model needs for a question, falling back to the default confidence
+        """
+        self.cursor.execute("SELECT confidence FROM question_thresholds WHERE question = ?", (question,))
+        row = self.cursor.fetchone()
+        return self.confidence if row is None or row[0] is None else row[0]
+
+    async def match(self, tweet_text: str, question: str) -> List[Union[bool, str]]:
+        fast_match, confidence = await self.fast.match_with_confidence(tweet_text, question)
+        self.stats["total"] += 1
+
+        if confidence >= self.get_confidence(question):
+            self.stats["fast"] += 1
+            if random.random() < self.audit_rate:
+                strong_match = await self.strong.match(tweet_text, question)
+                self.fast.record_outcome(tweet_text, question, strong_match[0])
+                self.stats["audited"] += 1
+                self.stats["agreed"] += strong_match[0] == fast_match[0]
+            return fast_match
+
+        self.stats["escalated"] += 1
+        strong_match = await self.strong.match(tweet_text, question)
+        self.fast.record_outcome(tweet_text, question, strong_match[0])
+        self.stats["escalated_agreed"] += strong_match[0] == fast_match[0]
+        return strong_match
+
+    def summary(self) -> str:
+        """
+        Returns the escalation rate and the agreement between both models
+        """
+        total = max(self.stats["total"], 1)
+        audited = max(self.stats["audited"], 1)
+        escalated = max(self.stats["escalated"], 1)
+        return (
+            f"Classified: {self.stats['total']}\n"
+            f"Escalated: {self.stats['escalated']} ({self.stats['escalated'] / total:.1%})\n"
+            f"Agreement on confident answers: {self.stats['agreed'] / audited:.1%} of {self.stats['audited']} audited\n"
+            f"Agreement on escalated answers: {self.stats['escalated_agreed'] / escalated:.1%}"
+        )
+
+
+def create_matcher(engine: str, cursor: Cursor) -> Matcher:
+    """
+    Creates the matcher for the given engine name
+
+    Parameters
+    ----------
+    engine : str
+    "completion", "embedding" or "cascade"
+
+    cursor : sqlite3.Cursor
+    The database cursor
+
+    Returns
+    -------
+    Matcher
+    """
+
+    if engine == "cascade":
+        if CASCADE_FAST_MODEL == "local":
+            fast = EmbeddingMatcher(cursor, embed=local_embed)
+        else:
+            fast = CompletionMatcher(CASCADE_FAST_MODEL)
+        return CascadeMatcher(cursor, fast, CompletionMatcher())
+    if engine == "embedding":
+        return EmbeddingMatcher(cursor, fallback=CompletionMatcher())
+    if engine == "completion":
+        return CompletionMatcher()
+    raise ValueError(f"Unknown matcher engine: {engine}")
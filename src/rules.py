@@ -0,0 +1,278 @@
+import asyncio
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+import tweepy
+
+from .globals_ import UserLimitReached, RuleUpdateFailed
+
+from . import tweepy_logger
+
+# Max length of a stream rule
+MAX_RULE_LENGTH = 510
+
+# Max number of stream rules allowed by Twitter's API
+MAX_RULES = 5
+
+# Time in seconds the rule manager waits to group concurrent changes into one update
+RULES_BATCH_WINDOW = 0.5
+
+
+def pack_handles(handles: List[str], max_rules: int = MAX_RULES) -> List[str]:
+    """
+    Packs handles into as few "from:" stream rules as possible
+
+    Parameters
+    ----------
+    handles : list[str]
+    The handles to pack
+
+    max_rules : int
+    The number of rules available
+
+    Returns
+    -------
+    list[str]
+    The rule values
+
+    Raises
+    ------
+    UserLimitReached
+    If the handles don't fit in max_rules rules
+    """
+
+    queries = []
+    query = ""
+    for handle in handles:
+        term = f"from:{handle}"
+        # If the handle would cause the query to exceed the max rule length, start a new query
+        if query and len(query) + len(" OR ") + len(term) > MAX_RULE_LENGTH:
+            queries.append(query)
+            query = ""
+        query = f"{query} OR {term}" if query else term
+
+    if query:
+        queries.append(query)
+    if len(queries) > max_rules:
+        raise UserLimitReached
+    return queries
+
+
+def parse_rule(value: str) -> Optional[Set[str]]:
+    """
+    Returns the handles of a rule made of "from:" terms only, None for any other rule
+    """
+    terms = [term.strip() for term in value.split(" OR ")]
+    if not all(term.startswith("from:") and len(term) > len("from:") for term in terms):
+        return None
+    return {term[len("from:"):].lower() for term in terms}
+
+
+class RuleManager:
+    """
+    Single writer of the stream rules.
+
+    Commands submit the handles they want added, removed or tracked exclusively instead of
+    editing the rules themselves. Changes submitted within RULES_BATCH_WINDOW are combined and
+    applied with at most one delete and one add request, and each caller is told the outcome
+    of its own change.
+    """
+
+    def __init__(self, client: tweepy.asynchronous.AsyncStreamingClient) -> None:
+        self.client = client
+        # Rules managed by us, id -> handles, loaded from the API on the first batch
+        self.rules: Optional[Dict[str, Set[str]]] = None
+        # Number of rules not made by us, they count towards the rules limit
+        self.foreign_rules = 0
+        self.pending: List[Tuple[str, Set[str], asyncio.Future]] = []
+        self.flush_task: Optional[asyncio.Task] = None
+        # Held from loading the rules to applying them, so that only one batch talks to the API at a time
+        self.lock = asyncio.Lock()
+        self.stats = Counter()
+
+    async def submit(self, action: str, handles: List[str]) -> None:
+        """
+        Queues a change of the tracked handles and waits until it is applied
+
+        Parameters
+        ----------
+        action : str
+        "add", "remove" or "replace"
+
+        handles : list[str]
+        The handles to add, remove or track instead of the current ones
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        UserLimitReached
+        If adding the handles would exceed the number of rules allowed
+
+        RuleUpdateFailed
+        If Twitter rejected the combined update
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((action, {handle.lower() for handle in handles}, future))
+        self.stats["intents"] += 1
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush())
+        await future
+
+    async def load_rules(self) -> None:
+        """
+        Fetches the current rules and keeps the ones made of "from:" terms
+        """
+        self.rules = {}
+        self.foreign_rules = 0
+        rules = (await self.client.get_rules()).data
+        self.stats["api_calls"] += 1
+        for rule in rules or []:
+            handles = parse_rule(rule.value)
+            if handles is None:
+                self.foreign_rules += 1
+            else:
+                self.rules[str(rule.id)] = handles
+
+    def plan(self, handles: Set[str]) -> Tuple[List[str], List[str]]:
+        """
+        Computes the rules to delete and the rule values to add so that the rules track exactly the given handles
+
+        Rules whose handles are all still tracked are kept untouched, the handles of the other rules
+        are packed with the new handles. Everything is repacked if that needs too many rules.
+
+        Returns
+        -------
+        tuple[list[str],list[str]]
+        The ids of the rules to delete and the values of the rules to add
+
+        Raises
+        ------
+        UserLimitReached
+        If the handles don't fit in the rules available
+        """
+
+        max_rules = MAX_RULES - self.foreign_rules
+        kept = {rule_id: rule for rule_id, rule in self.rules.items() if rule <= handles}
+        covered = set().union(*kept.values())
+        added = pack_handles(sorted(handles - covered), max_rules)
+
+        if len(kept) + len(added) > max_rules:
+            return list(self.rules), pack_handles(sorted(handles), max_rules)
+        return [rule_id for rule_id in self.rules if rule_id not in kept], added
+
+    async def flush(self) -> None:
+        """
+        Applies the changes submitted during the batch window in one update and resolves their futures
+        """
+        await asyncio.sleep(RULES_BATCH_WINDOW)
+        async with self.lock:
+            # Changes submitted from now on wait for the next batch, which starts once this one is applied
+            pending, self.pending = self.pending, []
+            self.flush_task = None
+            if len(pending) > 0:
+                await self.apply_pending(pending)
+
+    async def apply_pending(self, pending: List[Tuple[str, Set[str], asyncio.Future]]) -> None:
+        """
+        Combines a batch of changes into one update and resolves their futures
+        """
+        try:
+            if self.rules is None:
+                await self.load_rules()
+
+            # Apply the changes in the order they were submitted, rejecting the ones that don't fit
+            handles = set().union(*self.rules.values())
+            accepted = []
+            for action, change, future in pending:
+                if action == "add":
+                    candidate = handles | change
+                elif action == "remove":
+                    candidate = handles - change
+                else:
+                    candidate = set(change)
+
+                try:
+                    pack_handles(sorted(candidate), MAX_RULES - self.foreign_rules)
+                except UserLimitReached as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                handles = candidate
+                accepted.append(future)
+
+            await self.apply(handles)
+        except Exception as e:
+            # The rules are unknown after a failed update, reload them on the next batch
+            self.rules = None
+            for _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.stats["batches"] += 1
+        tweepy_logger.info(f"Applied {len(accepted)} rule changes in one update")
+        for future in accepted:
+            if not future.done():
+                future.set_result(None)
+
+    async def apply(self, handles: Set[str]) -> None:
+        """
+        Updates the rules to track exactly the given handles
+
+        The new rules are added before the old ones are deleted when the rules limit allows it,
+        otherwise the deleted rules are restored if the add fails, so that a failed update never
+        leaves tracked handles without a rule.
+        """
+        delete_ids, add_values = self.plan(handles)
+
+        if len(self.rules) + self.foreign_rules + len(add_values) <= MAX_RULES:
+            await self.add_rules(add_values)
+            await self.delete_rules(delete_ids)
+            return
+
+        deleted = {rule_id: self.rules[rule_id] for rule_id in delete_ids}
+        await self.delete_rules(delete_ids)
+        try:
+            await self.add_rules(add_values)
+        except Exception:
+            tweepy_logger.warning(f"Restoring {len(deleted)} deleted rules after a failed update")
+            await self.add_rules([" OR ".join(f"from:{handle}" for handle in sorted(rule)) for rule in deleted.values()])
+            raise
+
+    async def add_rules(self, values: List[str]) -> None:
+        """
+        Adds rules and records the ones Twitter accepted
+        """
+        if len(values) == 0:
+            return
+        response = await self.client.add_rules([tweepy.StreamRule(value) for value in values])
+        self.stats["api_calls"] += 1
+        for rule in response.data or []:
+            self.rules[str(rule.id)] = parse_rule(rule.value)
+        if response.errors:
+            raise RuleUpdateFailed(response.errors)
+
+    async def delete_rules(self, rule_ids: List[str]) -> None:
+        """
+        Deletes rules by id
+        """
+        if len(rule_ids) == 0:
+            return
+        await self.client.delete_rules(rule_ids)
+        self.stats["api_calls"] += 1
+        for rule_id in rule_ids:
+            del self.rules[rule_id]
+
+    async def close(self) -> None:
+        """
+        Stops waiting for new changes, the ones already submitted are applied first
+        """
+        if self.flush_task is not None:
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        # Wait for a batch that was already being applied when the last flush started
+        async with self.lock:
+            pass
@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from sqlite3 import Cursor
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from .matchers import Matcher
+
+from . import tweepy_logger
+
+
+@dataclass(order=True)
+class Job:
+    """
+    A (tweet, question) pair waiting to be classified.
+    """
+
+    finish_tag: float
+    seq: int
+    author_id: int = field(compare=False)
+    priority: int = field(compare=False)
+    deadline: float = field(compare=False)
+    tweet_text: str = field(compare=False)
+    question: str = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    cancelled: bool = field(default=False, compare=False)
+
+
+class ClassificationScheduler:
+    """
+    Weighted fair queue in front of the matcher.
+
+    Every author gets a share of the workers proportional to its priority, so a noisy account
+    can't starve the others. Jobs older than the max staleness of their author are dropped when
+    they reach the front of the queue. When the backlog is full the job the queue would serve last
+    is degraded to the prefilter, or dropped if there is no prefilter.
+    """
+
+    def __init__(
+        self,
+        matcher: Matcher,
+        cursor: Cursor,
+        prefilter: Optional[Matcher] = None,
+        concurrency: int = 4,
+        max_backlog: int = 200,
+    ) -> None:
+        self.matcher = matcher
+        self.prefilter = prefilter
+        self.cursor = cursor
+        self.concurrency = concurrency
+        self.max_backlog = max_backlog
+
+        self.queue: List[Job] = []
+        self.backlog = 0
+        self.virtual_time = 0.0
+        self.last_finish: Dict[int, float] = {}
+        self.seq = itertools.count()
+        self.ready: Optional[asyncio.Event] = None
+        self.workers: List[asyncio.Task] = []
+        self.degraded_tasks: Set[asyncio.Task] = set()
+        self.degraded_slots: Optional[asyncio.Semaphore] = None
+        self.stats = Counter()
+
+    def get_policy(self, author_id: int) -> Tuple[int, float]:
+        """
+        Returns the priority and max staleness in seconds of an author
+        """
+        self.cursor.execute("SELECT priority, max_staleness FROM users WHERE id = ?", (author_id,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return 1, float("inf")
+        priority, max_staleness = row
+        return max(priority or 1, 1), float("inf") if max_staleness is None else max_staleness
+
+    async def submit(self, author_id: int, tweet_text: str, question: str) -> Optional[List[Union[bool, str]]]:
+        """
+        Queues a tweet for classification and waits for its verdict
+
+        Parameters
+        ----------
+        author_id : int
+        The id of the author of the tweet
+
+        tweet_text : str
+        The text of the tweet
+
+        question : str
+        The question to check for
+
+        Returns
+        -------
+        list[bool,str] or None
+        The verdict of the matcher or of the prefilter, None if the tweet was dropped
+        """
+
+        self.start()
+        priority, max_staleness = self.get_policy(author_id)
+
+        # Start time of an author is the current virtual time unless it is already behind in the queue
+        finish_tag = max(self.virtual_time, self.last_finish.get(author_id, 0.0)) + 1.0 / priority
+        self.last_finish[author_id] = finish_tag
+
+        job = Job(
+            finish_tag=finish_tag,
+            seq=next(self.seq),
+            author_id=author_id,
+            priority=priority,
+            deadline=time.monotonic() + max_staleness,
+            tweet_text=tweet_text,
+            question=question,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        heapq.heappush(self.queue, job)
+        self.backlog += 1
+        self.stats["submitted"] += 1
+
+        if self.backlog > self.max_backlog:
+            self.shed()
+
+        self.ready.set()
+        return await job.future
+
+    def shed(self) -> None:
+        """
+        Removes the job with the largest finish tag from the queue, stale jobs first among equals
+
+        That is the job the fair queue would serve last, so the author flooding the queue loses its
+        own tweets instead of quieter authors.
+        """
+        now = time.monotonic()
+        victim = max(
+            (job for job in self.queue if not job.cancelled),
+            key=lambda job: (job.finish_tag, now > job.deadline),
+        )
+        victim.cancelled = True
+        self.backlog -= 1
+
+        # Degraded jobs waiting for the prefilter are bounded by the backlog too
+        if self.prefilter is not None and len(self.degraded_tasks) < self.max_backlog:
+            self.stats["degraded"] += 1
+            task = asyncio.create_task(self.run_degraded(victim))
+            self.degraded_tasks.add(task)
+            task.add_done_callback(self.degraded_tasks.discard)
+        else:
+            self.stats["dropped_overflow"] += 1
+            victim.future.set_result(None)
+
+    async def run(self, matcher: Matcher, job: Job, degraded: bool = False) -> None:
+        """
+        Classifies a job with a matcher and resolves its future
+        """
+        try:
+            match = await matcher.match(job.tweet_text, job.question)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            # Tell degraded verdicts apart in the history and in Discord
+            if degraded:
+                match = [match[0], f"prefilter only, {match[1]}"]
+            if not job.future.done():
+                job.future.set_result(match)
+
+    async def run_degraded(self, job: Job) -> None:
+        """
+        Classifies a shed job with the prefilter, with no more requests in flight than the workers
+        """
+        async with self.degraded_slots:
+            await self.run(self.prefilter, job, degraded=True)
+
+    async def worker(self) -> None:
+        while True:
+            if self.backlog == 0:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            job = heapq.heappop(self.queue)
+            if job.cancelled:
+                continue
+            self.backlog -= 1
+            self.virtual_time = job.finish_tag
+
+            if time.monotonic() > job.deadline:
+                self.stats["dropped_stale"] += 1
+                tweepy_logger.info(f"Dropped stale tweet from {job.author_id} for question: {job.question}")
+                job.future.set_result(None)
+                continue
+
+            self.stats["classified"] += 1
+            await self.run(self.matcher, job)
+
+    def start(self) -> None:
+        """
+        Starts the worker tasks if they are not running
+        """
+        if len(self.workers) == 0:
+            # Created here so that the event belongs to the running loop
+            self.ready = asyncio.Event()
+            self.degraded_slots = asyncio.Semaphore(self.concurrency * (self.prefilter or self.matcher).batch_size)
+            # Batching matchers check several tweets per request, keep enough jobs in flight to fill their batches
+            self.workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency * self.matcher.batch_size)]
+
+    async def close(self) -> None:
+        """
+        Stops the workers and drops the jobs still queued
+        """
+        for task in self.workers + list(self.degraded_tasks):
+            task.cancel()
+        await asyncio.gather(*self.workers, *self.degraded_tasks, return_exceptions=True)
+        self.workers = []
+
+        for job in self.queue:
+            if not job.cancelled and not job.future.done():
+                job.future.set_result(None)
+        self.queue = []
+        self.backlog = 0
@@ -0,0 +1,140 @@
+from collections import defaultdict
+from sqlite3 import Connection
+from typing import Dict, List, Optional, Set, Tuple
+
+
+class SubscriptionIndex:
+    """
+    Inverted index from Twitter author id to the Discord channels subscribed to that author and their questions.
+
+    The subscriptions table is the source of truth, the index is kept in memory so that every
+    tweet of the shared stream can be fanned out without querying the database.
+    """
+
+    def __init__(self, cnx: Connection) -> None:
+        self.cnx = cnx
+        self.cursor = cnx.cursor()
+        # author id -> question -> set of channel ids
+        self.index: Dict[int, Dict[str, Set[int]]] = defaultdict(lambda: defaultdict(set))
+        self.reload()
+
+    def reload(self) -> None:
+        """
+        Rebuilds the index from the subscriptions table
+        """
+        self.index.clear()
+        self.cursor.execute("SELECT user_id, question, channel_id FROM subscriptions")
+        for user_id, question, channel_id in self.cursor.fetchall():
+            self.index[user_id][question].add(channel_id)
+
+    def subscribe(self, guild_id: Optional[int], channel_id: int, user_id: int, question: str) -> bool:
+        """
+        Subscribes a channel to the tweets of an author matching a question
+
+        Parameters
+        ----------
+        guild_id : int, optional
+        The id of the guild of the channel, None for direct messages
+
+        channel_id : int
+        The id of the channel
+
+        user_id : int
+        The id of the Twitter author
+
+        question : str
+        The question to check the tweets against
+
+        Returns
+        -------
+        bool
+        False if the channel was already subscribed to this author and question
+        """
+
+        self.cursor.execute(
+            "INSERT OR IGNORE INTO subscriptions (guild_id, channel_id, user_id, question) VALUES (?, ?, ?, ?)",
+            (guild_id, channel_id, user_id, question),
+        )
+        self.cnx.commit()
+        if self.cursor.rowcount == 0:
+            return False
+        self.index[user_id][question].add(channel_id)
+        return True
+
+    def fill_guild(self, channel_id: int, guild_id: int) -> int:
+        """
+        Sets the guild of the subscriptions of a channel stored without one, such as the ones migrated from the users table
+
+        Returns
+        -------
+        int
+        The number of updated subscriptions
+        """
+        self.cursor.execute(
+            "UPDATE subscriptions SET guild_id = ? WHERE channel_id = ? AND guild_id IS NULL",
+            (guild_id, channel_id),
+        )
+        self.cnx.commit()
+        return self.cursor.rowcount
+
+    def unsubscribe(self, channel_id: int, user_id: int) -> int:
+        """
+        Removes every subscription of a channel to an author
+
+        Parameters
+        ----------
+        channel_id : int
+        The id of the channel
+
+        user_id : int
+        The id of the Twitter author
+
+        Returns
+        -------
+        int
+        The number of removed subscriptions
+        """
+
+        self.cursor.execute(
+            "DELETE FROM subscriptions WHERE channel_id = ? AND user_id = ?", (channel_id, user_id)
+        )
+        self.cnx.commit()
+        removed = self.cursor.rowcount
+
+        questions = self.index.get(user_id, {})
+        for question in list(questions):
+            questions[question].discard(channel_id)
+            if len(questions[question]) == 0:
+                del questions[question]
+        if user_id in self.index and len(self.index[user_id]) == 0:
+            del self.index[user_id]
+        return removed
+
+    def is_subscribed(self, channel_id: int, user_id: int) -> bool:
+        """
+        Check if a channel is subscribed to an author.
+        """
+        return any(channel_id in channels for channels in self.index.get(user_id, {}).values())
+
+    def is_tracked(self, user_id: int) -> bool:
+        """
+        Check if at least one channel is subscribed to an author.
+        """
+        return user_id in self.index
+
+    def subscribers(self, user_id: int) -> Dict[str, Set[int]]:
+        """
+        Returns the questions asked about an author, each with the channels that asked it
+        """
+        return self.index.get(user_id, {})
+
+    def channel_subscriptions(self, channel_id: int) -> List[Tuple[int, str]]:
+        """
+        Returns the (author id, question) pairs a channel is subscribed to
+        """
+        return [
+            (user_id, question)
+            for user_id, questions in self.index.items()
+            for question, channels in questions.items()
+            if channel_id in channels
+        ]
@@ -1,16 +1,35 @@
+import asyncio
+import time
 from pickle import LIST
 import string
 import traceback
 from sqlite3 import Cursor
-from typing import List,Union
+from typing import List,Optional,Tuple,Union
 
 import tweepy
 import tweepy.asynchronous
-from .globals_ import GPT_QUERY_BASE, openai, discord, TWITTER_BEARER_TOKEN, UserLimitReached, create_error_embed
+from .globals_ import CURSOR, MATCHER_ENGINE, SCHEDULER_CONCURRENCY, SCHEDULER_MAX_BACKLOG, discord, TWITTER_BEARER_TOKEN, UserLimitReached, create_error_embed
+from .matchers import EmbeddingMatcher, create_matcher
+from .scheduler import ClassificationScheduler
+from .tenancy import SubscriptionIndex
+from .history import MatchHistory
+from .rules import RuleManager
 from tweepy.streaming import StreamResponse
 
 from . import tweepy_logger
 
+# Engine used by check_tweet_for_match, selected with the MATCHER_ENGINE environment variable
+MATCHER = create_matcher(MATCHER_ENGINE, CURSOR)
+
+# Cheap matcher used for the tweets shed when the classification backlog is full. Only the embedding
+# engine has calibrated thresholds, with the other engines shed tweets are dropped
+PREFILTER = EmbeddingMatcher(CURSOR, embed=MATCHER.embed) if isinstance(MATCHER, EmbeddingMatcher) else None
+
+# Queue ordering tweets by author priority in front of check_tweet_for_match
+SCHEDULER = ClassificationScheduler(
+    MATCHER, CURSOR, prefilter=PREFILTER, concurrency=SCHEDULER_CONCURRENCY, max_backlog=SCHEDULER_MAX_BACKLOG
+)
+
 async def check_tweet_for_match(tweet_text: str, question: str) -> List[Union[bool, str]]:
     """
     Checks if the tweet text contains the question
@@ -26,60 +45,154 @@ async def check_tweet_for_match(tweet_text: str, question: str) -> List[Union[bo
     Returns
     -------
     list[bool,str]
-    A list containing a boolean value indicating if the tweet text match the question and the gpt3 answer
+    A list containing a boolean value indicating if the tweet text match the question and the matcher answer
+
+    """
+
+    return await MATCHER.match(tweet_text, question)
+
 
+async def classify_tweet(tweet_id: int, author_id: int, tweet_text: str, question: str) -> Optional[List[Union[bool, str]]]:
     """
+    Checks a tweet against a question through the scheduler
+
+    Verdicts are not cached, process_tweet already checks each question once for all the channels
+    asking it, and a failed or shed check must not stick to the tweet.
+
+    Parameters
+    ----------
+    tweet_id : int
+    The id of the tweet
+
+    author_id : int
+    The id of the author of the tweet
+
+    tweet_text : str
+    The text of the tweet
 
-    # Construct the query by combining the question and tweet text
-    query = GPT_QUERY_BASE.format(tweet=tweet_text, question=question)
+    question : str
+    The question to check for
 
-    # Use OpenAI API to check tweet for match with question
-    response = openai.Completion.create(
-        engine="text-davinci-003",
-        prompt=query,
-        max_tokens=2048,
-        temperature=0.5,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
-    )
+    Returns
+    -------
+    list[bool,str] or None
+    The verdict of the scheduler, None if the tweet was shed
+    """
 
-    # Extract answer from API response
-    answer = response["choices"][0]["text"].strip().lower()
+    return await SCHEDULER.submit(author_id, tweet_text, question)
 
-    # Return a list indicating if "yes" is in the answer and the answer itself
-    return ["yes" in answer, answer]
+
+async def timed_classify_tweet(tweet_id: int, author_id: int, tweet_text: str, question: str) -> Tuple[Optional[List[Union[bool, str]]], float]:
+    """
+    Calls classify_tweet and returns its verdict along with the time in seconds it took
+    """
+    start = time.perf_counter()
+    match = await classify_tweet(tweet_id, author_id, tweet_text, question)
+    return match, time.perf_counter() - start
 
 
 class MyStreamListener(tweepy.asynchronous.AsyncStreamingClient):
-    def __init__(self, channel: discord.channel.TextChannel, cursor: Cursor, **kwargs) -> None:
+    def __init__(self, client: discord.Client, index: SubscriptionIndex, history: MatchHistory, cursor: Cursor, **kwargs) -> None:
         super().__init__(
             bearer_token=TWITTER_BEARER_TOKEN, wait_on_rate_limit=True, **kwargs
         )
-        self.channel = channel
+        self.client = client
+        # Home channel receiving the status messages of the stream
+        self.channel = client.channel
+        self.index = index
+        self.history = history
         self.cursor = cursor
 
-    async def update_rules(self, rules):
-        """
-        Updates the rules of the twitter stream
+        # Serializes starting and stopping the stream so that only one stream task is ever running
+        self.lifecycle_lock = asyncio.Lock()
+        self.reconnect_task = None
+        self.stopping = False
+        self.closed = False
 
-        Parameters
-        ----------
-        rules : list[tweepy.StreamRule]
-        The rules to update
-        """
+        # Tasks classifying and sending the tweets received, the stream doesn't wait for them
+        self.tweet_tasks = set()
+
+        # Channels fetched from Discord because they were not cached, such as direct messages after a restart
+        self.fetched_channels = {}
 
-        await self.delete_rules(rules)
-        await self.add_rules(rules)
+        # Every change of the stream rules goes through the rule manager
+        self.rules = RuleManager(self)
 
     def custom_filter(self) -> None:
-        self.disconnect()
-        self.task = None
+        """
+        Starts the stream unless a stream task is already running
+        """
+        if self.closed or (self.task is not None and not self.task.done()):
+            return
+
+        self.reset_session()
         self.filter(
             expansions=["author_id"],
             user_fields=["username", "name", "profile_image_url"],
         )
 
+    def reset_session(self) -> None:
+        """
+        Forgets the session closed by tweepy when the stream ends, it would otherwise be reused for rule requests
+        """
+        if self.session is not None and self.session.closed:
+            self.session = None
+
+    async def stop_stream(self) -> None:
+        """
+        Cancels the stream task and waits for it to end without reconnecting
+        """
+        task = self.task
+        if task is None or task is asyncio.current_task():
+            return
+
+        self.stopping = True
+        try:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        finally:
+            self.stopping = False
+        self.task = None
+
+    async def restart(self) -> None:
+        """
+        Stops the running stream task, if any, and starts a new one
+        """
+        async with self.lifecycle_lock:
+            await self.stop_stream()
+            self.custom_filter()
+
+    async def close(self) -> None:
+        """
+        Stops the stream for good, the listener can't be restarted afterwards
+        """
+        self.closed = True
+        if self.reconnect_task is not None and self.reconnect_task is not asyncio.current_task():
+            self.reconnect_task.cancel()
+            await asyncio.gather(self.reconnect_task, return_exceptions=True)
+        async with self.lifecycle_lock:
+            await self.stop_stream()
+        for task in self.tweet_tasks:
+            task.cancel()
+        await asyncio.gather(*self.tweet_tasks, return_exceptions=True)
+        await self.rules.close()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        # Rule changes made after closing, such as removing a user while stopped, open their own session
+        self.session = None
+
+    async def reconnect(self) -> None:
+        """
+        Reloads the stream rules from the database and restarts the stream
+        """
+        self.reset_session()
+        self.cursor.execute("SELECT handle FROM users")
+        handles = [handle[0] for handle in self.cursor.fetchall()]
+        tweepy_logger.info(f"Handles amount is: {len(handles)} " )
+        if len(handles) > 0:
+            await self.load_handles_from_list(handles)
+            await self.restart()
+
     async def load_handles_from_list(self, handles : LIST) -> None:
         """
         Updates the handles in the twitter stream to match the handles in the database
@@ -87,42 +200,14 @@ class MyStreamListener(tweepy.asynchronous.AsyncStreamingClient):
         Parameters
         ----------
         handles : List[str]
-        The handles to add
+        The handles to track
 
         Returns
         -------
         None
         """
-        
-        # print(type(rules))
-            
-        query = ""
-        query_list = []
-        for handle in handles:
-            # If the handle would cause the query to exceed 510 characters, add the current query to the list and reset the query
-            if len(query) + len(handle[0]) > 510:
-                query_list.append(query)
-                query = ""
-                # If the number of queries exceeds the maximum number allowed by Twitter's API, raise an exception
-                if len(query_list) == 5:
-                    raise UserLimitReached
-
-            query += f"from:{handle} OR "
-
-        # Add the final query to the list
-        query_list.append(query)
-
-        rules = (await self.get_rules()).data
-        if rules is not None:
-            await self.delete_rules(rules)
-        
-        # Add each query as a stream rule
-        for query in query_list:
-            query = query.rstrip(" OR ")
-            temp_rule = tweepy.StreamRule(query)
-            await self.add_rules(temp_rule)
 
-        # print((await self.get_rules()).data)
+        await self.rules.submit("replace", handles)
 
     async def add_handle(self, handle: str) -> None:
         """
@@ -138,36 +223,24 @@ class MyStreamListener(tweepy.asynchronous.AsyncStreamingClient):
         None
         """
 
-        rules = (await self.get_rules()).data
-
-        # If there are no current rules, create a new rule with the handle
-        if rules is None or len(rules) == 0:
-            temp_rule = tweepy.StreamRule(f"from:{handle}")
-            await self.add_rules(temp_rule)
-            # print((await self.get_rules()).data)
-            return None
-
-        for rule in rules:
-            # If the handle can be added to the current rule without exceeding 510 characters, update the rule with the handle
-            if len(rule.value) + len(handle) < 510:
-                new_query = rule.value + f" OR from:{handle}"
-                new_rule = tweepy.StreamRule(value=new_query, id=rule.id)
-                await self.update_rules(new_rule)
-                # print((await self.get_rules()).data)
-                return None
-
-        # If the handle cannot be added to any of the current rules, create a new rule with the handle
-        if len(rules) < 5:
-            temp_rule = tweepy.StreamRule(f"from:{handle}")
-            await self.add_rules(temp_rule)
-            # print((await self.get_rules()).data)
-            return None
-
-        # print((await self.get_rules()).data)
-        # If the number of queries exceeds the maximum number allowed by Twitter's API, raise an exception
-        raise UserLimitReached
+        await self.rules.submit("add", [handle])
+
+    async def add_handles(self, handles: List[str]) -> None:
+        """
+        Adds handles to the twitter stream
+
+        Parameters
+        ----------
+        handles : List[str]
+        The handles to add
+
+        Returns
+        -------
+        None
+        """
+
+        await self.rules.submit("add", handles)
 
-        
     async def remove_handle(self, handle: str) -> None:
         """
         Removes a handle from the twitter stream
@@ -182,26 +255,33 @@ class MyStreamListener(tweepy.asynchronous.AsyncStreamingClient):
         None
         """
 
-        rules = (await self.get_rules()).data
-        # print(type(rules))
-        for rule in rules:
-            # If the rule contains the handle, update the rule with the handle removed
-            if f"from:{handle}" in rule.value:
-                await self.delete_rules(rule)
-                new_query = rule.value.replace(f"from:{handle} OR ", "")
-                new_query = new_query.replace(f"from:{handle}", "")
-                new_query = new_query.rstrip(" OR ")
-                new_rule = tweepy.StreamRule(value=new_query, id=rule.id)
-                print(await self.add_rules(new_rule))
-                # print((await self.get_rules()).data)
-                return
-            
-    async def send_tweet_discord(self, user : dict, tweet : dict, question: str, match: List) -> None:
+        await self.rules.submit("remove", [handle])
+
+    async def remove_handles(self, handles: List[str]) -> None:
+        """
+        Removes handles from the twitter stream
+
+        Parameters
+        ----------
+        handles : List[str]
+        The handles to remove
+
+        Returns
+        -------
+        None
+        """
+
+        await self.rules.submit("remove", handles)
+
+    async def send_tweet_discord(self, channel: discord.abc.Messageable, user : dict, tweet : dict, question: str, match: List) -> None:
         """
         Sends a tweet to discord
         
         Parameters
         ----------
+        channel : discord.abc.Messageable
+        The channel to send the tweet to
+
         user : dict
         The user who sent the tweet
         
@@ -219,7 +299,7 @@ class MyStreamListener(tweepy.asynchronous.AsyncStreamingClient):
         None
         """
   
-        await self.channel.send("New tweet")
+        await channel.send("New tweet")
         embed = discord.embeds.Embed(
             title=f"{user.name} (@{user.username})",
             url=f"https://twitter.com/{user.username}/status/{tweet.id}",
@@ -241,7 +321,7 @@ class MyStreamListener(tweepy.asynchronous.AsyncStreamingClient):
             text="Tweet Match",
             icon_url="https://abs.twimg.com/icons/apple-touch-icon-192x192.png",
         )
-        await self.channel.send(embed=embed)
+        await channel.send(embed=embed)
         
     async def on_response(self, response: StreamResponse) -> None:
 
@@ -250,25 +330,83 @@ class MyStreamListener(tweepy.asynchronous.AsyncStreamingClient):
         tweet = response.data
         user = response.includes["users"][0]
 
-        # print(response)
+        # Copy the subscribers so that commands running meanwhile don't change them under us
+        subscribers = {question: set(channels) for question, channels in self.index.subscribers(user.id).items()}
 
-        # Get question for tweet author from database
-        self.cursor.execute("""SELECT question FROM users WHERE id=?""", (user.id,))
-        question = self.cursor.fetchone()[0]
+        # Hand the tweet off so that the stream keeps reading while it waits in the scheduler
+        task = asyncio.create_task(self.process_tweet(user, tweet, subscribers))
+        self.tweet_tasks.add(task)
+        task.add_done_callback(self.tweet_done)
 
-        match = await check_tweet_for_match(tweet.text, question)
+    def tweet_done(self, task: asyncio.Task) -> None:
+        self.tweet_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            tweepy_logger.error("Failed to process tweet", exc_info=task.exception())
 
-        # print(f"{tweet.text} {question} {str(match[0])} {match[1]}")
+    async def process_tweet(self, user, tweet, subscribers: dict) -> None:
+        """
+        Checks a tweet against the questions of its subscribers and sends it to the channels it matches
+
+        Parameters
+        ----------
+        user : tweepy.User
+        The author of the tweet
 
-        # If the tweet text match the question, send the tweet to discord
-        if match[0]:
-            await self.send_tweet_discord(user, tweet,question, match)
-            await super().on_response(response)
-            # print("Match found " + tweet)
+        tweet : tweepy.Tweet
+        The tweet to check
+
+        subscribers : dict[str, set[int]]
+        The channels subscribed to the author, by question
+
+        Returns
+        -------
+        None
+        """
+
+        questions = list(subscribers)
+
+        # Each question is checked once and its verdict is shared by every channel asking it
+        results = await asyncio.gather(
+            *(timed_classify_tweet(tweet.id, user.id, tweet.text, question) for question in questions),
+            return_exceptions=True,
+        )
+
+        for question, result in zip(questions, results):
+            # A failed question must not cost the other questions their verdict
+            if isinstance(result, BaseException):
+                tweepy_logger.error(f"Failed to classify tweet {tweet.id} for question: {question}", exc_info=result)
+                continue
+            match, latency = result
+
+            # The scheduler sheds stale tweets under load
+            if match is None:
+                continue
+            self.history.record(tweet.id, user.id, user.username, tweet.text, question, match[0], match[1], latency)
+
+            # If the tweet text match the question, send the tweet to every subscribed channel
+            if not match[0]:
+                continue
             tweepy_logger.info(f"Tweet match: {tweet.text} {question} {str(match[0])} {match[1]}")
+            for channel_id in subscribers[question]:
+                # A channel we can't post to only misses its own tweets
+                try:
+                    channel = await self.get_subscribed_channel(channel_id)
+                    await self.send_tweet_discord(channel, user, tweet, question, match)
+                except Exception:
+                    tweepy_logger.exception(f"Failed to send tweet {tweet.id} to channel {channel_id}")
+
+    async def get_subscribed_channel(self, channel_id: int) -> discord.abc.Messageable:
+        """
+        Returns a subscribed channel from the Discord cache, fetching it from Discord if it isn't cached
+        """
+        channel = self.client.get_channel(channel_id) or self.fetched_channels.get(channel_id)
+        if channel is None:
+            channel = await self.client.fetch_channel(channel_id)
+            self.fetched_channels[channel_id] = channel
+        return channel
 
     async def on_exception(self, exception):
-        await super().on_exception()
+        await super().on_exception(exception)
         #tweepy_logger.error(
         #    "".join(
         #        traceback.format_exception(
@@ -276,22 +414,20 @@ class MyStreamListener(tweepy.asynchronous.AsyncStreamingClient):
         #        )
         #    )
         #)
-        await self.channel.send(embed=create_error_embed(exception))
+        await self.channel.send(embed=create_error_embed("Twitter stream", exception))
 
         
     async def on_disconnect(self):
         await super().on_disconnect()
+        # Disconnections requested by stop_stream must not reconnect
+        if self.stopping or self.closed:
+            return
+
         await self.channel.send("Disconnected from Twitter")
-        self.cursor.execute("SELECT COUNT(*) FROM users")
-        count = self.cursor.fetchone()[0]
-        if count > 0:   
-            self.cursor.execute("SELECT handle FROM users")
-            handles = [handle[0] for handle in self.cursor.fetchall()]
-            tweepy_logger.info(f"Handles amount is: {len(handles)} " )
-            await self.load_handles_from_list(handles)
-            self.custom_filter()
-        
-        
+        # Reconnect from a separate task, this one is the stream task that is ending
+        if self.reconnect_task is None or self.reconnect_task.done():
+            self.reconnect_task = asyncio.create_task(self.reconnect())
+
     async def on_connect(self):
         await super().on_connect()
         await self.channel.send("Connected to Twitter")